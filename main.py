@@ -2,10 +2,21 @@ import os
 import imapclient
 import smtplib
 from email.message import EmailMessage
-from email.header import decode_header
-from email import message_from_bytes # Specific parser for received emails
+from email.utils import parseaddr
+from email.parser import BytesParser # Specific parser for received emails
+from email import policy
 import re
 import ssl # For secure SMTP connection
+import codecs
+import threading
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import re2 # google-re2: linear-time matching, immune to catastrophic backtracking
+except ImportError:
+    re2 = None # Fall back to the standard library engine
 
 # --- Configuration (Get from GitHub Secrets, with Gmail defaults) ---
 # IMPORTANT: These are placeholders. You MUST set these as GitHub Secrets.
@@ -18,17 +29,74 @@ IMAP_PORT = int(os.getenv("IMAP_PORT", 993))
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SENDER_EMAIL = GMAIL_USER # The email address your service sends from
+# Only these headers are downloaded for multipart emails (see fetch_messages); PEEK leaves \Seen alone
+FETCH_HEADERS = 'BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]'
+MAX_SCAN_BYTES = 256 * 1024 # Only this much of a body is scanned; real requests are far shorter
+# Server-side search filter: automated senders never get a useful reply, so their emails are left
+# unread and never fetched
+IGNORED_SENDERS = ("noreply", "no-reply") # Matched as substrings of the From header by the server
+SEARCH_CRITERIA = ['UNSEEN'] + [term for sender in IGNORED_SENDERS for term in ('NOT', 'FROM', sender)]
+DEBUG = os.getenv("EXTRACTOR_DEBUG") == "1" # Set to 1 for per-email debug output
+SMTP_WORKERS = int(os.getenv("SMTP_WORKERS", 8)) # Emails processed (and SMTP connections open) in parallel
+# Long-running mode: stay logged in and wait for new mail with IMAP IDLE instead of exiting after one
+# pass. Leave off for the scheduled GitHub Actions workflow; use it when hosting the script as a worker.
+IDLE_MODE = os.getenv("EXTRACTOR_IDLE") == "1"
+IDLE_TIMEOUT = 29 * 60 # Gmail drops IDLE connections after ~30 minutes, so re-issue IDLE before that
+IDLE_RECONNECT_DELAY = 30 # Seconds to wait before reconnecting after the IMAP connection fails
+IDLE_RECONNECT_MAX_DELAY = 15 * 60 # The wait doubles after each failed reconnect, up to this many seconds
 
 # --- Regular Expressions for Extraction ---
 # URL Regex: Catches http/https and www. prefixed URLs.
-# This is a robust-enough regex for most common URLs in plain text.
-URL_REGEX = r"(?:https?://|www\.)(?:[a-zA-Z0-9.\-]+(?:\.[a-zA-Z]{2,})?|localhost)(?::\d{1,5})?(?:/[^\s()]*)?" \
-            r"(?:\([^\s()]*\))*" # Added to allow parentheses in URLs like Wikipedia
+# A single character class with a single '+' so the match can't backtrack catastrophically on
+# crafted input. Trailing punctuation is trimmed afterwards by _clean_url.
+URL_REGEX = r"(?:https?://|www\.)[^\s<>\"']+"
+URL_TRAILING_PUNCTUATION = ".,;:!?"
+MAX_URL_LENGTH = 2048 # Longer matches are almost certainly garbage (or an attack), skip them
 
 # Email Regex: Catches standard email formats.
 EMAIL_REGEX = r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}"
 
+def _compile(pattern):
+    """Compiles an extraction pattern with RE2 when available, otherwise with re."""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass # Pattern uses a feature RE2 doesn't support; use re instead
+    return re.compile(pattern)
+
+# Compiled once at import so each extraction call skips the re module's pattern cache lookup.
+# Both patterns are pure ASCII, so they're compiled as bytes and run straight over the raw (UTF-8)
+# body without decoding it to str first; only the matches get decoded.
+_URL_RE = _compile(URL_REGEX.encode())
+_EMAIL_RE = _compile(EMAIL_REGEX.encode())
+# Single alternation so a body is scanned once for both kinds; m.lastindex says which one matched.
+# (Not m.lastgroup: RE2 reports group names of a bytes pattern as bytes, re reports them as str.)
+_COMBINED_PATTERN = f"(?P<url>{URL_REGEX})|(?P<email>{EMAIL_REGEX})".encode()
+_COMBINED_RE = _compile(_COMBINED_PATTERN)
+_URL_GROUP = 1 # Neither pattern has capturing groups of its own, so url is group 1 and email group 2
+# In a bytes pattern \s only covers ASCII whitespace, so the UTF-8 forms of NBSP, NEL and the other
+# Unicode spaces are turned into b' ' before scanning; otherwise a URL match runs straight through them.
+# Always compiled with re: RE2 would read these bytes as Latin-1 code points and never match them.
+_UNICODE_SPACE_RE = re.compile(rb"\xc2[\xa0\x85]|\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80")
+
+# IMPORTANT: Replace 'YourExtractor.your-subdomain.com' with your actual subdomain/service name
+RESPONSE_FOOTER = "\n\n---\nPowered by YourExtractor.your-subdomain.com"
+
+# Per-email debug output goes through this logger; log.debug skips formatting when DEBUG is off
+log = logging.getLogger(__name__)
+
+# Parser using the modern email policy: emails come back as EmailMessage objects, which provide
+# get_body() and headers that are already decoded (get_email_body and the Subject rely on both)
+_PARSER = BytesParser(policy=policy.default)
+
 # --- Email Connection Functions ---
+# Each worker thread keeps its own SMTP connection (smtplib sessions can't be shared between
+# threads); every connection opened is also recorded so process_emails can close them all.
+_smtp_local = threading.local()
+_smtp_sessions = []
+_smtp_sessions_lock = threading.Lock()
+
 def connect_to_imap():
     """Establishes a secure IMAP connection to Gmail."""
     try:
@@ -53,173 +121,437 @@ def connect_to_smtp():
         print(f"Error connecting to SMTP: {e}")
         raise # Re-raise the exception
 
-def get_email_body(msg):
-    """Extracts plain text body from an email. Handles multipart emails."""
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            cdispo = str(part.get('Content-Disposition'))
-            # Look for plain text body, ignoring attachments and HTML parts
-            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                try:
-                    # Decode payload using its specified charset or utf-8/latin-1 fallback
-                    charset = part.get_content_charset()
-                    return part.get_payload(decode=True).decode(charset if charset else 'utf-8', errors='ignore')
-                except (UnicodeDecodeError, LookupError):
-                    return part.get_payload(decode=True).decode('latin-1', errors='ignore') # Fallback
-    else:
+def _find_text_part(structure, prefix=""):
+    """Returns the IMAP part number (e.g. '1' or '2.1') of the first non-attachment text/plain
+    part in a multipart BODYSTRUCTURE, or None if there isn't one."""
+    for index, part in enumerate(structure[0], start=1):
+        number = f"{prefix}{index}"
+        if part.is_multipart:
+            found = _find_text_part(part, number + ".")
+            if found:
+                return found
+        elif part[0].lower() == b'text' and part[1].lower() == b'plain':
+            # Single part fields: type, subtype, params, id, description, encoding, size, lines, md5, disposition, ...
+            disposition = part[9] if len(part) > 9 else None
+            if not (disposition and disposition[0].lower() == b'attachment'):
+                return number
+    return None
+
+def _header_fields(message_data):
+    """Returns the raw header block fetched with HEADER.FIELDS, whatever quoting the server used in the key."""
+    for key, value in message_data.items():
+        if key.startswith(b'BODY[HEADER.FIELDS'):
+            return value or b""
+    return b""
+
+def fetch_messages(imap_server, uids):
+    """Fetches and parses the given emails without downloading attachments. Returns {uid: message}.
+
+    Only the From/Subject headers and the first text/plain part are downloaded and then parsed as
+    one small single-part message. Emails that aren't multipart, or whose structure can't be read,
+    are fetched whole. Every fetch uses BODY.PEEK so nothing gets marked as seen here.
+
+    Responses for UIDs that weren't asked for (unsolicited FETCH responses, e.g. a FLAGS change made
+    by another client, keyed by sequence number) are ignored. So is an email whose data is missing;
+    it stays unread and is retried next run.
+    """
+    requested = set(uids)
+    parsed = {}
+    full_fetch_uids = []
+    text_part_uids = {} # IMAP part number -> UIDs whose text/plain part has that number
+    headers = {}
+
+    for uid, message_data in imap_server.fetch(uids, ['BODYSTRUCTURE', FETCH_HEADERS]).items():
+        if uid not in requested:
+            continue
         try:
-            charset = msg.get_content_charset()
-            return msg.get_payload(decode=True).decode(charset if charset else 'utf-8', errors='ignore')
-        except (UnicodeDecodeError, LookupError):
-            return msg.get_payload(decode=True).decode('latin-1', errors='ignore')
-    return ""
-
-def send_email(to_email, subject, body):
-    """Sends an email using the configured SMTP server."""
-    smtp_server = None
+            structure = message_data[b'BODYSTRUCTURE']
+            if not structure.is_multipart:
+                full_fetch_uids.append(uid) # The whole message is the body, nothing to skip
+                continue
+            headers[uid] = _header_fields(message_data)
+            part = _find_text_part(structure)
+        except Exception as e:
+            print(f"UID {uid}: Could not read BODYSTRUCTURE ({e}), fetching the full message.")
+            full_fetch_uids.append(uid)
+            continue
+        if part:
+            text_part_uids.setdefault(part, []).append(uid)
+        else:
+            parsed[uid] = _PARSER.parsebytes(headers[uid]) # No plain text body, the subject is all we can use
+
+    for part, part_uids in text_part_uids.items():
+        for uid, message_data in imap_server.fetch(part_uids, [f'BODY.PEEK[{part}.MIME]', f'BODY.PEEK[{part}]']).items():
+            if uid not in part_uids:
+                continue
+            # Graft the part's own MIME headers (Content-Type, Content-Transfer-Encoding) under the
+            # message's From/Subject so the result parses like a plain single-part email. Without
+            # MIME headers a blank line still has to end the header block, or the body becomes headers.
+            header_block = headers[uid].rstrip(b"\r\n")
+            raw_email = (header_block + b"\r\n" if header_block else b"") \
+                        + (message_data.get(f'BODY[{part}.MIME]'.encode()) or b"\r\n") \
+                        + (message_data.get(f'BODY[{part}]'.encode()) or b"")
+            parsed[uid] = _PARSER.parsebytes(raw_email)
+
+    if full_fetch_uids:
+        for uid, message_data in imap_server.fetch(full_fetch_uids, ['BODY.PEEK[]']).items():
+            raw_email = message_data.get(b'BODY[]')
+            if uid in full_fetch_uids and raw_email is not None:
+                parsed[uid] = _PARSER.parsebytes(raw_email) # Parse the raw email content
+
+    return parsed
+
+def _scannable_payload(part):
+    """Returns a part's decoded payload as UTF-8 (or plain ASCII) bytes the extraction regexes can scan.
+
+    UTF-8 and ASCII payloads, which is nearly all of them, are returned as-is without decoding.
+    Other charsets are transcoded, since e.g. UTF-16 or ISO-2022-JP bytes can't be matched directly.
+    """
+    payload = part.get_payload(decode=True) or b""
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        if codecs.lookup(charset).name in ('utf-8', 'ascii'):
+            return payload
+        return payload.decode(charset, errors='ignore').encode('utf-8')
+    except (UnicodeDecodeError, LookupError):
+        return payload.decode('latin-1', errors='ignore').encode('utf-8') # Fallback
+
+def get_email_body(msg):
+    """Extracts plain text body from an email as UTF-8 bytes. Handles multipart emails."""
+    if not msg.is_multipart():
+        return _scannable_payload(msg) # A single-part email is scanned whatever its type (e.g. text/html)
+    # get_body skips attachments and stops at the first suitable part instead of walking them all
+    body = msg.get_body(preferencelist=('plain',))
+    return _scannable_payload(body) if body else b""
+
+def send_email(to_email, subject, body, smtp_server):
+    """Sends an email over an already open SMTP connection.
+
+    Returns the connection to use for the next send, which is a fresh one if the server had
+    dropped the old one.
+    """
     try:
-        smtp_server = connect_to_smtp()
         msg = EmailMessage()
         msg.set_content(body)
         msg['Subject'] = subject
         msg['From'] = SENDER_EMAIL
         msg['To'] = to_email
-        smtp_server.send_message(msg)
+        try:
+            smtp_server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+            # A server timing out an idle session may answer 421 and hang up instead of just disconnecting
+            if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code != 421:
+                raise
+            print("SMTP connection was closed by the server, reconnecting...")
+            smtp_server = connect_to_smtp()
+            smtp_server.send_message(msg)
         print(f"Sent email to {to_email} with subject '{subject}'")
     except Exception as e:
         print(f"Failed to send email to {to_email}: {e}")
         # Consider logging this failure more prominently or notifying an admin
-    finally:
-        if smtp_server:
-            smtp_server.quit()
+    return smtp_server
 
 # --- Extraction Logic ---
-def extract_urls(text):
-    """Finds and returns unique URLs from a given text."""
-    found_urls = re.findall(URL_REGEX, text)
+def _clean_url(url):
+    """Trims trailing punctuation from a raw URL match. Returns None if the match should be dropped."""
+    # Cut at the first Unicode space _UNICODE_SPACE_RE doesn't cover (e.g. U+1680)
+    url = url.split(None, 1)[0]
+    if len(url) > MAX_URL_LENGTH:
+        return None
+    # Strip sentence punctuation, and closing parentheses that don't close one opened inside the
+    # URL, so "(see https://example.com)." loses the ")." but Wikipedia's "Foo_(bar)" keeps its ")"
+    while url and (url[-1] in URL_TRAILING_PUNCTUATION or (url[-1] == ')' and url.count('(') < url.count(')'))):
+        url = url[:-1]
     # Filter out potential false positives or malformed matches (e.g., very short matches)
-    cleaned_urls = [url for url in found_urls if len(url) > 5 and '.' in url] # Basic sanity check
-    return sorted(list(set(cleaned_urls))) # Remove duplicates and sort alphabetically
+    if len(url) > 5 and '.' in url: # Basic sanity check
+        return url
+    return None
+
+def _normalise_spaces(payload):
+    """Replaces UTF-8 encoded Unicode spaces with b' ' so the bytes patterns treat them as whitespace."""
+    return _UNICODE_SPACE_RE.sub(b" ", payload)
+
+def extract_urls(payload):
+    """Finds and returns unique URLs from UTF-8 encoded text."""
+    return _find_urls(_normalise_spaces(payload))
+
+def _find_urls(payload):
+    """extract_urls for a payload that has already been through _normalise_spaces."""
+    found_urls = {_clean_url(url.decode('utf-8', errors='ignore')) for url in _URL_RE.findall(payload)}
+    found_urls.discard(None) # Matches _clean_url rejected
+    return sorted(found_urls) # Set removes duplicates, sorted alphabetically
+
+def extract_emails(payload):
+    """Finds and returns unique email addresses from UTF-8 encoded text."""
+    found_emails = {email.decode('ascii') for email in _EMAIL_RE.findall(payload)} # The pattern only matches ASCII
+    return sorted(found_emails) # Set removes duplicates, sorted alphabetically
 
-def extract_emails(text):
-    """Finds and returns unique email addresses from a given text."""
-    found_emails = re.findall(EMAIL_REGEX, text)
-    return sorted(list(set(found_emails))) # Remove duplicates and sort alphabetically
+def extract_urls_and_emails(payload):
+    """Finds unique URLs and email addresses in one pass over UTF-8 encoded text. Returns (urls, emails)."""
+    payload = _normalise_spaces(payload)
+    # Plain substring checks are much cheaper than a regex walk and rule out most texts; only run
+    # the pattern(s) that can actually match something
+    may_have_urls = b'://' in payload or b'www.' in payload
+    may_have_emails = b'@' in payload
+    if not may_have_emails:
+        return (_find_urls(payload) if may_have_urls else []), []
+    if not may_have_urls:
+        return [], extract_emails(payload)
+
+    urls, emails = set(), set()
+    for match in _COMBINED_RE.finditer(payload):
+        found = match.group()
+        if match.lastindex == _URL_GROUP:
+            if b'@' in found: # The alternation consumed any email inside the URL (e.g. "?to=bob@x.com"); recover it
+                emails.update(email.decode('ascii') for email in _EMAIL_RE.findall(found))
+            found = _clean_url(found.decode('utf-8', errors='ignore'))
+            if found:
+                urls.add(found)
+        else:
+            emails.add(found.decode('ascii'))
+    return sorted(urls), sorted(emails) # Sorted alphabetically, duplicates already removed by the sets
 
 # --- Main Processing Logic ---
-def process_emails():
-    """Connects to IMAP, processes unread emails, and sends replies."""
-    imap_server = None # Initialize to None for finally block
+def _thread_smtp():
+    """Returns this worker thread's SMTP connection, opening it on first use."""
+    smtp_server = getattr(_smtp_local, 'server', None)
+    if smtp_server is None:
+        smtp_server = _remember_smtp(connect_to_smtp())
+    return smtp_server
+
+def _remember_smtp(smtp_server, replaces=None):
+    """Stores an SMTP connection as this thread's session and registers it for closing at the end of the run.
+
+    If it replaces a dropped connection, that one is unregistered so long runs don't accumulate dead sessions.
+    """
+    _smtp_local.server = smtp_server
+    with _smtp_sessions_lock:
+        if replaces is not None:
+            _smtp_sessions.remove(replaces)
+        _smtp_sessions.append(smtp_server)
+    return smtp_server
+
+def _send_reply(to_email, subject, body):
+    """Sends a reply over this worker thread's SMTP connection."""
+    smtp_server = _thread_smtp()
+    new_server = send_email(to_email, subject, body, smtp_server)
+    if new_server is not smtp_server: # send_email had to reconnect
+        smtp_server.close() # Already disconnected by the server; just release the socket
+        _remember_smtp(new_server, replaces=smtp_server)
+
+def _response_lines(extracted_urls, extracted_emails):
+    """Yields the lines of the reply body, to be joined with newlines."""
+    yield "Hello from your Extractor Bot!"
+    yield "\nHere are the extracted items from your text:\n"
+
+    if extracted_urls:
+        yield "\n--- Found URLs ---"
+        yield from (f"- {url}" for url in extracted_urls)
+        yield "\n" # Add a blank line for separation
+
+    if extracted_emails:
+        yield "\n--- Found Email Addresses ---"
+        yield from (f"- {email}" for email in extracted_emails)
+        yield "\n" # Add a blank line for separation
+
+    if not extracted_urls and not extracted_emails:
+        yield "\nNo URLs or email addresses were found in your text."
+        yield "\nTips: Ensure URLs start with http:// or https:// (or www.) and email addresses are in standard format like user@domain.com."
+
+def process_one(uid, msg):
+    """Extracts URLs/emails from one parsed email and replies to the sender.
+
+    Runs in a worker thread and never touches the IMAP connection. Returns the UID if the email
+    should be marked as seen, or None if processing failed and it should be retried next run.
+    """
     try:
-        imap_server = connect_to_imap()
-        imap_server.select_folder('INBOX')
+        # Extract sender's email address
+        sender_email_raw = msg['From']
+        sender_email = parseaddr(sender_email_raw)[1] or sender_email_raw # "Name <user@domain.com>" -> user@domain.com
+        log.debug("\n--- Processing Email UID: %s from: %s ---", uid, sender_email)
+
+        # Extract subject (policy.default has already decoded any RFC 2047 encoded words)
+        subject = str(msg['Subject'] or "")
+
+        body = get_email_body(msg)
+
+        # Determine the text to process (prioritize body, then subject)
+        text_to_process = body.strip()
+        if not text_to_process and subject.strip(): # If body is empty, use subject
+             text_to_process = subject.strip().encode('utf-8')
+             log.debug("UID %s: No body text found, processing subject.", uid)
+        elif text_to_process: # If body has text
+            log.debug("UID %s: Processing email body.", uid)
+        else: # If both are empty
+            log.debug("UID %s: No text found in email body or subject.", uid)
+
+        if log.isEnabledFor(logging.DEBUG): # Skip decoding the preview entirely when not debugging
+            log.debug("UID %s: Text to process (first 200 bytes): '%s'...", uid, text_to_process[:200].decode('utf-8', errors='replace'))
+            log.debug("UID %s: Full text length (bytes): %d", uid, len(text_to_process))
+
+        if len(text_to_process) > MAX_SCAN_BYTES: # Bounds the extraction cost for huge bodies
+            log.warning("UID %s: Text is %d bytes, only scanning the first %d.", uid, len(text_to_process), MAX_SCAN_BYTES)
+            text_to_process = text_to_process[:MAX_SCAN_BYTES]
+
+
+        if text_to_process:
+            extracted_urls, extracted_emails = extract_urls_and_emails(text_to_process)
+
+            log.debug("UID %s: Extracted URLs: %s", uid, extracted_urls)
+            log.debug("UID %s: Extracted Emails: %s", uid, extracted_emails)
+
+            # Prepare the response email body
+            response_body = "\n".join(_response_lines(extracted_urls, extracted_emails)) + RESPONSE_FOOTER
+            _send_reply(sender_email, "Your Extracted URLs & Emails", response_body)
+            log.debug("UID %s: Response sent (hopefully), will be marked as seen.", uid)
+        else:
+            # If no text was found in the email
+            _send_reply(sender_email, "Error: No Text Provided", "Please send an email with the text you want to process in the body or subject. I couldn't find any text to extract from.")
+            log.debug("UID %s: No text found, error email sent, will be marked as seen.", uid)
+        return uid # Mark even error emails as read to avoid reprocessing
+    except smtplib.SMTPAuthenticationError as e:
+        print(f"UID {uid}: SMTP Login Failed: {e}. Check your EMAIL_USER and EMAIL_PASS (App Password if using Gmail 2FA).")
+    except Exception as e:
+        print(f"UID {uid}: Failed to process email, leaving it unread for the next run: {e}")
+    return None
+
+def process_unseen(imap_server, executor):
+    """Processes one batch: every unread email in the selected folder gets a reply and is marked as seen.
+
+    Returns the UIDs the search found (including any that failed and were left unread).
+    """
+    log.debug("Searching for UNSEEN emails...")
+    messages = imap_server.search(SEARCH_CRITERIA) # Look for unread emails, filtered on the server
+
+    if not messages:
+        print("No new unread emails found.")
+        return messages
 
-        # --- DEBUG PRINT 1 ---
-        print("Searching for UNSEEN emails...")
-        messages = imap_server.search('UNSEEN') # Look for unread emails
+    print(f"Found {len(messages)} unread email(s). Processing...")
 
-        if not messages:
-            print("No new unread emails found. Exiting.")
-            return
+    # Fetch and parse everything up front: the IMAP connection isn't thread-safe, so only this
+    # thread talks to it. The workers only wait on SMTP.
+    parsed = fetch_messages(imap_server, messages)
+    seen_uids = [uid for uid in executor.map(process_one, parsed.keys(), parsed.values()) if uid is not None]
 
-        print(f"Found {len(messages)} unread email(s). Processing...")
+    if seen_uids:
+        mark_seen(imap_server, seen_uids)
+    return messages
 
-        for uid, message_data in imap_server.fetch(messages, ['RFC822']).items():
-            raw_email = message_data[b'RFC822']
-            msg = message_from_bytes(raw_email) # Parse the raw email content
+def mark_seen(imap_server, uids):
+    """Sets \\Seen on all the UIDs with one STORE, falling back to one STORE per UID if that fails."""
+    try:
+        imap_server.add_flags(uids, '\\Seen')
+        print(f"Marked {len(uids)} email(s) as seen.")
+        return
+    except imapclient.exceptions.IMAPClientAbortError:
+        raise # The connection itself is gone, per-UID retries would fail too
+    except imapclient.exceptions.IMAPClientError as e:
+        print(f"Could not mark the batch as seen ({e}), retrying one email at a time.")
+    marked = 0
+    for uid in uids:
+        try:
+            imap_server.add_flags(uid, '\\Seen')
+            marked += 1
+        except imapclient.exceptions.IMAPClientAbortError:
+            raise
+        except imapclient.exceptions.IMAPClientError as e:
+            print(f"UID {uid}: Could not mark as seen, it will be processed again next run: {e}")
+    print(f"Marked {marked} of {len(uids)} email(s) as seen.")
+
+def wait_for_new_mail(imap_server):
+    """Blocks in IMAP IDLE until the server reports mailbox changes or IDLE_TIMEOUT passes."""
+    imap_server.idle()
+    try:
+        responses = imap_server.idle_check(timeout=IDLE_TIMEOUT)
+    finally:
+        imap_server.idle_done()
+    log.debug("IDLE returned: %s", responses or "timeout, refreshing")
 
-            # Extract sender's email address
-            sender_email_raw = msg['From']
-            match = re.search(r'<(.*?)>', sender_email_raw)
-            sender_email = match.group(1) if match else sender_email_raw
-            print(f"\n--- Processing Email UID: {uid} from: {sender_email} ---") # DEBUG PRINT 2
+def _logout(imap_server):
+    """Logs out of IMAP, reporting (not raising) any error."""
+    try:
+        imap_server.logout()
+        print("IMAP server logged out.")
+    except Exception as e:
+        print(f"Error during IMAP logout: {e}")
 
-            # Extract subject
-            subject = ""
+def reconnect_imap():
+    """Reconnects to IMAP and reselects INBOX, retrying with exponential backoff until it succeeds."""
+    delay = IDLE_RECONNECT_DELAY
+    while True:
+        print(f"Reconnecting to IMAP in {delay}s...")
+        time.sleep(delay)
+        imap_server = None
+        try:
+            imap_server = connect_to_imap()
+            imap_server.select_folder('INBOX')
+            return imap_server
+        except Exception as e: # connect_to_imap already printed the details
+            print(f"IMAP reconnect failed: {e}")
+            if imap_server:
+                _logout(imap_server)
+            delay = min(delay * 2, IDLE_RECONNECT_MAX_DELAY)
+
+def process_emails():
+    """Connects to IMAP, processes unread emails, and sends replies.
+
+    With IDLE_MODE on, keeps the IMAP connection, worker threads and their SMTP connections open
+    and processes each new batch as it arrives instead of returning.
+    """
+    imap_server = None # Initialize to None for finally block
+    executor = ThreadPoolExecutor(max_workers=SMTP_WORKERS) # Threads (and their SMTP sessions) live for the whole run
+    try:
+        imap_server = connect_to_imap()
+        imap_server.select_folder('INBOX')
+
+        idle_first = False # Set after a failed batch so it isn't retried in a tight loop
+        while True:
             try:
-                subject_header = decode_header(msg['Subject'])
-                decoded_parts = []
-                for s, charset in subject_header:
-                    if isinstance(s, bytes):
-                        # Decode based on charset, or utf-8/latin-1 fallback, ignore errors for robustness
-                        decoded_parts.append(s.decode(charset if charset else 'utf-8', errors='ignore'))
-                    else:
-                        decoded_parts.append(s)
-                subject = "".join(decoded_parts)
+                if idle_first:
+                    idle_first = False
+                    wait_for_new_mail(imap_server)
+                batch = process_unseen(imap_server, executor)
+                if not IDLE_MODE:
+                    break
+                # Mail that arrived while the batch was being processed announced itself before IDLE
+                # started, so IDLE would never report it. Check once more before idling; UIDs from this
+                # batch that failed are left out so they can't keep us from idling.
+                if batch and set(imap_server.search(SEARCH_CRITERIA)) - set(batch):
+                    continue
+                wait_for_new_mail(imap_server)
+            except (imapclient.exceptions.IMAPClientError, OSError) as e:
+                if not IDLE_MODE:
+                    raise
+                print(f"IMAP connection problem: {e}")
+                _logout(imap_server)
+                imap_server = None
+                imap_server = reconnect_imap()
             except Exception as e:
-                print(f"Could not decode subject for UID {uid}: {e}") # DEBUG PRINT
-                pass # Subject might be empty or malformed
-
-            body = get_email_body(msg)
-
-            # Determine the text to process (prioritize body, then subject)
-            text_to_process = body.strip()
-            if not text_to_process and subject.strip(): # If body is empty, use subject
-                 text_to_process = subject.strip()
-                 print(f"UID {uid}: No body text found, processing subject.") # DEBUG PRINT
-            elif text_to_process: # If body has text
-                print(f"UID {uid}: Processing email body.") # DEBUG PRINT
-            else: # If both are empty
-                print(f"UID {uid}: No text found in email body or subject.") # DEBUG PRINT
-
-            # --- DEBUG PRINT 3 ---
-            print(f"UID {uid}: Text to process (first 200 chars): '{text_to_process[:200]}'...")
-            print(f"UID {uid}: Full text length: {len(text_to_process)}")
-
-
-            if text_to_process:
-                extracted_urls = extract_urls(text_to_process)
-                extracted_emails = extract_emails(text_to_process)
-
-                # --- DEBUG PRINT 4 ---
-                print(f"UID {uid}: Extracted URLs: {extracted_urls}")
-                print(f"UID {uid}: Extracted Emails: {extracted_emails}")
-
-                # Prepare the response email body
-                response_parts = []
-                response_parts.append("Hello from your Extractor Bot!")
-                response_parts.append("\nHere are the extracted items from your text:\n")
-
-                if extracted_urls:
-                    response_parts.append("\n--- Found URLs ---")
-                    response_parts.extend([f"- {url}" for url in extracted_urls])
-                    response_parts.append("\n") # Add a blank line for separation
-
-                if extracted_emails:
-                    response_parts.append("\n--- Found Email Addresses ---")
-                    response_parts.extend([f"- {email}" for email in extracted_emails])
-                    response_parts.append("\n") # Add a blank line for separation
-
-                if not extracted_urls and not extracted_emails:
-                    response_parts.append("\nNo URLs or email addresses were found in your text.")
-                    response_parts.append("\nTips: Ensure URLs start with http:// or https:// (or www.) and email addresses are in standard format like user@domain.com.")
-
-                # IMPORTANT: Replace 'YourExtractor.your-subdomain.com' with your actual subdomain/service name
-                response_body = "\n".join(response_parts) + f"\n\n---\nPowered by YourExtractor.your-subdomain.com"
-                send_email(sender_email, "Your Extracted URLs & Emails", response_body)
-                imap_server.add_flags(uid, '\\Seen') # Mark email as read after successful processing
-                print(f"UID {uid}: Email marked as seen and response sent (hopefully).") # DEBUG PRINT 5
-            else:
-                # If no text was found in the email
-                send_email(sender_email, "Error: No Text Provided", "Please send an email with the text you want to process in the body or subject. I couldn't find any text to extract from.")
-                imap_server.add_flags(uid, '\\Seen') # Mark even error emails as read to avoid reprocessing
-                print(f"UID {uid}: No text found, error email sent and marked as seen.") # DEBUG PRINT 6
+                if not IDLE_MODE:
+                    raise
+                # One bad batch mustn't stop the long-running worker; try again after the next IDLE wait
+                print(f"Processing a batch failed, retrying after the next IDLE wait: {e}")
+                idle_first = True
 
     except imapclient.exceptions.LoginError as e:
         print(f"IMAP Login Failed: {e}. Check your EMAIL_USER and EMAIL_PASS (App Password if using Gmail 2FA).")
-    except smtplib.SMTPAuthenticationError as e:
-        print(f"SMTP Login Failed: {e}. Check your EMAIL_USER and EMAIL_PASS (App Password if using Gmail 2FA).")
     except Exception as e:
         print(f"An unexpected error occurred during email processing: {e}")
         # In a real application, you'd want more robust error logging/notifications here.
     finally:
-        if imap_server:
+        executor.shutdown()
+        with _smtp_sessions_lock:
+            sessions = list(_smtp_sessions)
+            _smtp_sessions.clear()
+        for smtp_server in sessions:
             try:
-                imap_server.logout()
-                print("IMAP server logged out.")
+                smtp_server.quit()
             except Exception as e:
-                print(f"Error during IMAP logout: {e}")
+                print(f"Error during SMTP quit: {e}")
+        if imap_server:
+            _logout(imap_server)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.WARNING, format="%(message)s")
     process_emails()
@@ -0,0 +1,178 @@
+import re
+import smtplib
+import unittest
+from unittest import mock
+
+from imapclient.response_parser import parse_fetch_response
+
+import main
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+def _engines():
+    """The regex engines main.py can end up using: always re, plus google-re2 when it is installed."""
+    engines = [("re", re)]
+    if re2 is not None:
+        engines.append(("re2", re2))
+    return engines
+
+
+class ExtractUrlsAndEmailsTest(unittest.TestCase):
+    def run_with(self, engine, payload):
+        """Runs extract_urls_and_emails with all extraction patterns compiled by the given engine."""
+        with mock.patch.object(main, "_URL_RE", engine.compile(main.URL_REGEX.encode())), \
+             mock.patch.object(main, "_EMAIL_RE", engine.compile(main.EMAIL_REGEX.encode())), \
+             mock.patch.object(main, "_COMBINED_RE", engine.compile(main._COMBINED_PATTERN)):
+            return main.extract_urls_and_emails(payload)
+
+    def test_combined_pass_separates_urls_and_emails(self):
+        for name, engine in _engines():
+            with self.subTest(engine=name):
+                self.assertEqual(
+                    self.run_with(engine, b"see https://example.com/a and bob@x.com here"),
+                    (["https://example.com/a"], ["bob@x.com"]))
+
+    def test_combined_pass_handles_non_ascii_urls(self):
+        payload = "www.café.fr and ok@ok.io".encode("utf-8")
+        for name, engine in _engines():
+            with self.subTest(engine=name):
+                self.assertEqual(self.run_with(engine, payload), (["www.café.fr"], ["ok@ok.io"]))
+
+    def test_url_ends_at_unicode_whitespace(self):
+        payload = "https://t.co/x\u00a0next and https://a.io/y\u2003z".encode("utf-8")
+        for name, engine in _engines():
+            with self.subTest(engine=name):
+                self.assertEqual(self.run_with(engine, payload), (["https://a.io/y", "https://t.co/x"], []))
+
+    def test_text_after_unicode_whitespace_is_still_scanned(self):
+        cases = {
+            "links: https://a.com/x\u00a0and\u00a0https://b.com/y\u00a0mail\u00a0bob@x.com":
+                (["https://a.com/x", "https://b.com/y"], ["bob@x.com"]),
+            "https://a.com/x\u3000www.b.com\u2028c@d.io": (["https://a.com/x", "www.b.com"], ["c@d.io"]),
+            # A long NBSP-separated line must not push the first URL past MAX_URL_LENGTH
+            "https://a.com/x" + "\u00a0word" * 500: (["https://a.com/x"], []),
+        }
+        for name, engine in _engines():
+            for text, expected in cases.items():
+                with self.subTest(engine=name, text=text[:40]):
+                    self.assertEqual(self.run_with(engine, text.encode("utf-8")), expected)
+        self.assertEqual(main.extract_urls("https://a.com/x\u00a0https://b.com/y".encode("utf-8")),
+                         ["https://a.com/x", "https://b.com/y"])
+
+    def test_combined_pass_finds_emails_inside_urls(self):
+        cases = {
+            b"see https://a.com/?to=bob@x.com ok": (["https://a.com/?to=bob@x.com"], ["bob@x.com"]),
+            b"https://user@example.com/path": (["https://user@example.com/path"], ["user@example.com"]),
+            b"mail www.john@gmail.com": (["www.john@gmail.com"], ["www.john@gmail.com"]),
+            b"https://a.com,bob@x.com": (["https://a.com,bob@x.com"], ["bob@x.com"]),
+        }
+        for name, engine in _engines():
+            for payload, expected in cases.items():
+                with self.subTest(engine=name, payload=payload):
+                    self.assertEqual(self.run_with(engine, payload), expected)
+                    # Same emails as the single-pattern path finds on its own
+                    self.assertEqual(expected[1], main.extract_emails(payload))
+
+
+def _literal(prefix, data):
+    """One IMAP literal the way imaplib hands it over: (b'... {size}', data)."""
+    return (prefix + b" {%d}" % len(data), data)
+
+
+HEADERS = b'From: Bob <bob@x.com>\r\nSubject: hello\r\n\r\n'
+HEADER_FIELDS = b'BODY[HEADER.FIELDS ("FROM" "SUBJECT")]' # Gmail quotes the field names
+MULTIPART = (b'(("text" "html" NIL NIL NIL "7bit" 8 1 NIL NIL NIL NIL)'
+             b'("text" "plain" NIL NIL NIL "7bit" 9 1 NIL ("attachment" ("filename" "a.txt")) NIL NIL)'
+             b'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 20 1 NIL NIL NIL NIL)'
+             b' "mixed" ("boundary" "B") NIL NIL NIL)')
+NO_TEXT_PART = (b'(("text" "html" NIL NIL NIL "7bit" 8 1 NIL NIL NIL NIL)'
+                b'("image" "png" NIL NIL NIL "base64" 8 NIL NIL NIL NIL)'
+                b' "mixed" ("boundary" "B") NIL NIL NIL)')
+SINGLE_PART = b'("text" "html" ("charset" "utf-8") NIL NIL "7bit" 30 1 NIL NIL NIL NIL)'
+
+
+class FakeIMAP:
+    """Answers fetch() from canned raw server responses, parsed exactly as imapclient parses them."""
+
+    def __init__(self, responses):
+        self.responses = responses # tuple of fetch items -> raw response lines
+        self.fetches = []
+
+    def fetch(self, uids, items):
+        self.fetches.append((list(uids), list(items)))
+        return parse_fetch_response(self.responses[tuple(items)])
+
+
+class FetchMessagesTest(unittest.TestCase):
+    def structure_response(self, *entries):
+        lines = []
+        for seq, uid, structure in entries:
+            lines.append(_literal(b"%d (UID %d BODYSTRUCTURE %s %s" % (seq, uid, structure, HEADER_FIELDS), HEADERS))
+            lines.append(b")")
+        return lines
+
+    def test_fetches_only_the_first_inline_text_plain_part(self):
+        imap = FakeIMAP({
+            ("BODYSTRUCTURE", main.FETCH_HEADERS): self.structure_response((1, 10, MULTIPART))
+                + [b"7 (FLAGS (\\Seen))"], # Unsolicited: another client changed flags on message 7
+            ("BODY.PEEK[3.MIME]", "BODY.PEEK[3]"): [
+                _literal(b"1 (UID 10 BODY[3.MIME]", b"Content-Type: text/plain; charset=utf-8\r\n\r\n"),
+                _literal(b" BODY[3]", b"see https://a.com ok"),
+                b")",
+            ],
+        })
+        parsed = main.fetch_messages(imap, [10])
+        self.assertEqual(list(parsed), [10]) # The unsolicited response is not treated as an email
+        self.assertEqual(main.get_email_body(parsed[10]), b"see https://a.com ok") # Attachment (part 2) skipped
+        self.assertEqual(str(parsed[10]["Subject"]), "hello")
+        self.assertEqual(imap.fetches[1][1], ["BODY.PEEK[3.MIME]", "BODY.PEEK[3]"])
+
+    def test_missing_mime_headers_keep_the_body_out_of_the_headers(self):
+        imap = FakeIMAP({
+            ("BODYSTRUCTURE", main.FETCH_HEADERS): self.structure_response((1, 10, MULTIPART)),
+            ("BODY.PEEK[3.MIME]", "BODY.PEEK[3]"): [_literal(b"1 (UID 10 BODY[3.MIME] NIL BODY[3]", b"Links: https://a.com"), b")"],
+        })
+        parsed = main.fetch_messages(imap, [10])
+        self.assertEqual(main.get_email_body(parsed[10]), b"Links: https://a.com") # Looks like a header, must stay body
+
+    def test_email_without_text_part_keeps_only_headers(self):
+        imap = FakeIMAP({("BODYSTRUCTURE", main.FETCH_HEADERS): self.structure_response((1, 10, NO_TEXT_PART))})
+        parsed = main.fetch_messages(imap, [10])
+        self.assertEqual(main.get_email_body(parsed[10]), b"")
+        self.assertEqual(str(parsed[10]["Subject"]), "hello")
+        self.assertEqual(len(imap.fetches), 1) # Nothing beyond the structure was downloaded
+
+    def test_single_part_email_is_fetched_whole(self):
+        raw = b"From: bob@x.com\r\nSubject: hi\r\nContent-Type: text/html\r\n\r\n<p>www.a.com</p>"
+        imap = FakeIMAP({
+            ("BODYSTRUCTURE", main.FETCH_HEADERS): self.structure_response((1, 10, SINGLE_PART)),
+            ("BODY.PEEK[]",): [_literal(b"1 (UID 10 BODY[]", raw), b")", b"4 (FLAGS ())"],
+        })
+        parsed = main.fetch_messages(imap, [10])
+        self.assertEqual(list(parsed), [10])
+        self.assertEqual(parsed[10]["From"], "bob@x.com")
+        self.assertEqual(main.get_email_body(parsed[10]), b"<p>www.a.com</p>") # Single-part HTML is still scanned
+
+
+class SendEmailTest(unittest.TestCase):
+    def test_reconnects_and_resends_after_421(self):
+        stale, fresh = mock.Mock(), mock.Mock()
+        stale.send_message.side_effect = smtplib.SMTPSenderRefused(421, b"4.4.2 Timeout, closing connection", "me@x.com")
+        with mock.patch.object(main, "connect_to_smtp", return_value=fresh):
+            self.assertIs(main.send_email("bob@x.com", "subject", "body", stale), fresh)
+        fresh.send_message.assert_called_once()
+
+    def test_other_refusals_are_not_retried(self):
+        server = mock.Mock()
+        server.send_message.side_effect = smtplib.SMTPSenderRefused(550, b"5.7.1 Rejected", "me@x.com")
+        with mock.patch.object(main, "connect_to_smtp") as connect:
+            self.assertIs(main.send_email("bob@x.com", "subject", "body", server), server)
+        connect.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()